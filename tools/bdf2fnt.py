@@ -6,7 +6,12 @@ BDF to FNT converter for TianShanOS LED Matrix
 BDF 是标准位图字体格式，由 otf2bdf 等工具生成。
 
 用法:
-    python3 bdf2fnt.py input.bdf output.fnt [--width W] [--height H]
+    python3 bdf2fnt.py input.bdf output.fnt [--width W] [--height H] [--no-cache]
+
+    解析结果缓存在 BDF 同目录的 .bdfcache 文件中，BDF 未修改时再次转换/验证直接加载。
+
+可选依赖:
+    pip install numpy numba  # 批量并行渲染
 
 FNT 格式 (兼容 ts_led_font.c):
     Header (16 bytes):
@@ -27,173 +32,318 @@ FNT 格式 (兼容 ts_led_font.c):
         - Bits packed MSB first, row by row
 """
 
+import os
 import struct
+import pickle
 import argparse
 import re
 from pathlib import Path
 
+# 可选：NumPy + Numba 批量渲染内核（未安装时回退到逐字形渲染）
+try:
+    import numpy as np
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+# parse_bdf 状态机状态
+_TOP = 0         # 文件头 / 字形之间
+_IN_GLYPH = 1    # STARTCHAR 之后, BITMAP 之前
+_IN_BITMAP = 2   # BITMAP 之后, ENDCHAR 之前
+
 
-def parse_bdf(bdf_path: str) -> tuple[dict, list[tuple[int, int, int, list[int]]]]:
+def parse_bdf(bdf_path: str) -> tuple[dict, list[dict]]:
     """
     解析 BDF 文件
     
+    逐行流式解析（单遍状态机），不把整个文件读入内存。
+    
     Returns:
         (properties, glyphs)
         properties: dict with font properties
-        glyphs: list of (encoding, width, height, bitmap_rows)
+        glyphs: list of glyph dicts (encoding, dwidth, bbx_*, bitmap_bytes, bytes_per_row)
+                bitmap_bytes 为所有位图行拼接后的原始字节，
+                每行 bytes_per_row = (bbx_w + 7) // 8 字节, MSB 在左
     """
     properties = {}
     glyphs = []
     
-    with open(bdf_path, 'r', encoding='latin-1') as f:
-        lines = f.readlines()
+    state = _TOP
+    glyph = None
+    hex_rows = None
     
-    i = 0
-    while i < len(lines):
-        line = lines[i].strip()
-        
-        # Parse properties
-        if line.startswith('FONTBOUNDINGBOX '):
-            parts = line.split()
-            properties['fbb_width'] = int(parts[1])
-            properties['fbb_height'] = int(parts[2])
-            properties['fbb_x'] = int(parts[3])
-            properties['fbb_y'] = int(parts[4])
-        elif line.startswith('FONT_ASCENT '):
-            properties['ascent'] = int(line.split()[1])
-        elif line.startswith('FONT_DESCENT '):
-            properties['descent'] = int(line.split()[1])
-        elif line.startswith('CHARS '):
-            properties['char_count'] = int(line.split()[1])
-        
-        # Parse glyph
-        elif line.startswith('STARTCHAR '):
-            encoding = None
-            bbx_w, bbx_h, bbx_x, bbx_y = 0, 0, 0, 0
-            dwidth = 0
-            bitmap_rows = []
+    with open(bdf_path, 'r', encoding='latin-1') as f:
+        for line in f:
+            line = line.rstrip()
             
-            i += 1
-            while i < len(lines):
-                gline = lines[i].strip()
-                
-                if gline.startswith('ENCODING '):
-                    encoding = int(gline.split()[1])
-                elif gline.startswith('DWIDTH '):
-                    dwidth = int(gline.split()[1])
-                elif gline.startswith('BBX '):
-                    parts = gline.split()
-                    bbx_w = int(parts[1])
-                    bbx_h = int(parts[2])
-                    bbx_x = int(parts[3])
-                    bbx_y = int(parts[4])
-                elif gline == 'BITMAP':
-                    i += 1
-                    while i < len(lines) and lines[i].strip() != 'ENDCHAR':
-                        hex_str = lines[i].strip()
-                        if hex_str:
-                            row_val = int(hex_str, 16)
-                            bitmap_rows.append(row_val)
-                        i += 1
-                    break
-                
-                i += 1
+            if state == _IN_BITMAP:
+                if line == 'ENDCHAR':
+                    if glyph['encoding'] is not None and glyph['encoding'] >= 0:
+                        # 存储原始 BDF 数据，整个字形的位图只解码一次
+                        glyph['bitmap_bytes'] = bytes.fromhex(''.join(hex_rows))
+                        glyph['bytes_per_row'] = (glyph['bbx_w'] + 7) // 8
+                        glyphs.append(glyph)
+                    glyph = None
+                    state = _TOP
+                else:
+                    hex_str = line.lstrip()
+                    if hex_str:
+                        hex_rows.append(hex_str)
+                continue
             
-            if encoding is not None and encoding >= 0:
-                # 存储原始 BDF 数据
-                glyphs.append({
-                    'encoding': encoding,
-                    'dwidth': dwidth,
-                    'bbx_w': bbx_w,
-                    'bbx_h': bbx_h,
-                    'bbx_x': bbx_x,
-                    'bbx_y': bbx_y,
-                    'bitmap': bitmap_rows
-                })
-        
-        i += 1
+            parts = line.split(maxsplit=1)
+            if not parts:
+                continue
+            keyword = parts[0]
+            
+            if state == _IN_GLYPH:
+                if keyword == 'ENCODING':
+                    glyph['encoding'] = int(parts[1].split()[0])
+                elif keyword == 'DWIDTH':
+                    glyph['dwidth'] = int(parts[1].split()[0])
+                elif keyword == 'BBX':
+                    bbx_w, bbx_h, bbx_x, bbx_y = map(int, parts[1].split()[:4])
+                    glyph['bbx_w'] = bbx_w
+                    glyph['bbx_h'] = bbx_h
+                    glyph['bbx_x'] = bbx_x
+                    glyph['bbx_y'] = bbx_y
+                elif keyword == 'BITMAP':
+                    state = _IN_BITMAP
+                elif keyword == 'ENDCHAR':
+                    # 没有 BITMAP 段的字形，丢弃
+                    glyph = None
+                    state = _TOP
+                continue
+            
+            # Parse properties
+            if keyword == 'FONTBOUNDINGBOX':
+                fbb = parts[1].split()
+                properties['fbb_width'] = int(fbb[0])
+                properties['fbb_height'] = int(fbb[1])
+                properties['fbb_x'] = int(fbb[2])
+                properties['fbb_y'] = int(fbb[3])
+            elif keyword == 'FONT_ASCENT':
+                properties['ascent'] = int(parts[1].split()[0])
+            elif keyword == 'FONT_DESCENT':
+                properties['descent'] = int(parts[1].split()[0])
+            elif keyword == 'CHARS':
+                properties['char_count'] = int(parts[1].split()[0])
+            
+            # Parse glyph
+            elif keyword == 'STARTCHAR':
+                hex_rows = []
+                glyph = {
+                    'encoding': None,
+                    'dwidth': 0,
+                    'bbx_w': 0,
+                    'bbx_h': 0,
+                    'bbx_x': 0,
+                    'bbx_y': 0,
+                    'bitmap_bytes': b'',
+                    'bytes_per_row': 0
+                }
+                state = _IN_GLYPH
     
     return properties, glyphs
 
 
-def render_glyph_to_fixed_size(glyph: dict, target_width: int, target_height: int,
-                                font_ascent: int, font_descent: int) -> bytes:
+# .bdfcache 文件格式版本，glyph 字典结构变化时递增
+BDF_CACHE_VERSION = 1
+
+
+def load_bdf(bdf_path: str, use_cache: bool = True) -> tuple[dict, list[dict]]:
     """
-    将 BDF 字形渲染到固定尺寸的位图
+    解析 BDF 文件，结果缓存在同目录的 .bdfcache 文件中
+    
+    BDF 文件的 mtime 和大小未变化时直接加载缓存，跳过解析；
+    缓存缺失、损坏或过期时重新解析并写入缓存（写入失败不影响结果）。
+    """
+    if not use_cache:
+        return parse_bdf(bdf_path)
+    
+    st = os.stat(bdf_path)
+    cache_key = (BDF_CACHE_VERSION, st.st_mtime_ns, st.st_size)
+    cache_path = Path(bdf_path).with_suffix('.bdfcache')
+    
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_key, parsed = pickle.load(f)
+        if cached_key == cache_key:
+            return parsed
+    except Exception:
+        pass
+    
+    parsed = parse_bdf(bdf_path)
+    
+    try:
+        tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((cache_key, parsed), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    
+    return parsed
+
+
+def make_glyph_renderer(target_width: int, target_height: int, font_ascent: int):
+    """
+    生成针对固定画布尺寸特化的字形渲染函数
     
     BDF 坐标系：
     - (0, 0) 是基线左端
     - y 向上为正
     - BBX 定义字形边界框相对于原点的位置
     
-    目标：将字形放在 target_width x target_height 的固定画布上
+    目标：将字形放在 target_width x target_height 的固定画布上。
+    与画布相关的常量（行掩码、每行在打包结果中的位移、每字形字节数）
+    只在这里计算一次，返回的 render(glyph) 对每个字形只做逐行移位。
     """
-    bbx_w = glyph['bbx_w']
-    bbx_h = glyph['bbx_h']
-    bbx_x = glyph['bbx_x']
-    bbx_y = glyph['bbx_y']
-    bitmap = glyph['bitmap']
+    bytes_per_glyph = (target_width * target_height + 7) // 8
+    # 画布逐行拼接 (MSB first)，末尾补零到字节边界
+    tail_bits = bytes_per_glyph * 8 - target_width * target_height
+    # 第 y 行在打包整数中的位移
+    row_shifts = tuple((target_height - 1 - y) * target_width + tail_bits
+                       for y in range(target_height))
+    row_mask = (1 << target_width) - 1
+    # BDF 的 y 坐标是从基线算起的，基线位置 = font_ascent（从顶部算起）
+    baseline_y = font_ascent - 1  # 0-indexed
+    empty = bytes(bytes_per_glyph)
+    
+    def render(glyph: dict) -> bytes:
+        bbx_w = glyph['bbx_w']
+        bbx_h = glyph['bbx_h']
+        bitmap = glyph['bitmap_bytes']
+        
+        if bbx_w == 0 or bbx_h == 0 or not bitmap:
+            # 空字符（如空格）
+            return empty
+        
+        # 字形顶部在画布上的 y 坐标
+        glyph_top_y = baseline_y - (glyph['bbx_y'] + bbx_h - 1)
+        
+        # BDF 位图是按字节存储的，MSB 在左边，每行对齐到字节边界
+        bytes_per_row = glyph['bytes_per_row']
+        pad_bits = bytes_per_row * 8 - bbx_w
+        # 字形行右移到画布位置所需的位移（负数表示超出画布右侧）
+        shift = target_width - glyph['bbx_x'] - bbx_w
+        
+        # 只处理落在画布内的行
+        first_row = max(0, -glyph_top_y)
+        last_row = min(len(bitmap) // bytes_per_row, target_height - glyph_top_y)
+        
+        mv = memoryview(bitmap)
+        packed = 0
+        for row_idx in range(first_row, last_row):
+            canvas_y = glyph_top_y + row_idx
+            offset = row_idx * bytes_per_row
+            row_val = int.from_bytes(mv[offset:offset + bytes_per_row], 'big') >> pad_bits
+            if shift >= 0:
+                row_val <<= shift
+            else:
+                row_val >>= -shift
+            packed |= (row_val & row_mask) << row_shifts[canvas_y]
+        
+        return packed.to_bytes(bytes_per_glyph, 'big')
     
-    # 创建目标画布 (target_height 行，每行 target_width 位)
-    canvas = [[0] * target_width for _ in range(target_height)]
+    return render
+
+
+def render_glyph_to_fixed_size(glyph: dict, target_width: int, target_height: int,
+                                font_ascent: int, font_descent: int) -> bytes:
+    """
+    将 BDF 字形渲染到固定尺寸的位图
     
-    if bbx_w == 0 or bbx_h == 0 or not bitmap:
-        # 空字符（如空格）
-        pass
-    else:
-        # 计算字形在画布上的位置
-        # BDF 的 y 坐标是从基线算起的，需要转换到像素坐标
-        # 基线位置 = font_ascent（从顶部算起）
-        baseline_y = font_ascent - 1  # 0-indexed
+    渲染多个字形时应使用 make_glyph_renderer 复用特化后的渲染函数。
+    """
+    return make_glyph_renderer(target_width, target_height, font_ascent)(glyph)
+
+
+def _render_all(bitmap_flat, bitmap_off, bbx, ascent, tw, th, canvas):
+    """
+    批量渲染内核：与 make_glyph_renderer 相同的 BDF→画布运算
+    
+    每个像素以 0/1 写入 canvas，打包由调用方对整个 canvas 一次 np.packbits 完成。
+    
+    Args:
+        bitmap_flat: 所有字形位图行拼接后的字节 (uint8)
+        bitmap_off: 每个字形在 bitmap_flat 中的起始偏移 (int64, N+1)
+        bbx: 每个字形的 (w, h, x, y) (int32, Nx4)
+        canvas: 输出画布，需预先清零 (uint8, N x th x tw)
+    """
+    n = bbx.shape[0]
+    for g in prange(n):
+        bbx_w = bbx[g, 0]
+        bbx_h = bbx[g, 1]
+        start = bitmap_off[g]
+        end = bitmap_off[g + 1]
+        if bbx_w == 0 or bbx_h == 0 or start == end:
+            continue
         
-        # 字形顶部在画布上的 y 坐标
-        glyph_top_y = baseline_y - (bbx_y + bbx_h - 1)
+        byte_width = (bbx_w + 7) // 8
+        glyph_top_y = ascent - 1 - (bbx[g, 3] + bbx_h - 1)
+        glyph_left_x = bbx[g, 2]
         
-        # 字形左侧在画布上的 x 坐标
-        glyph_left_x = bbx_x
+        # 裁剪到画布范围内，内层循环无需边界判断
+        row_lo = max(0, -glyph_top_y)
+        row_hi = min((end - start) // byte_width, th - glyph_top_y)
+        bit_lo = max(0, -glyph_left_x)
+        bit_hi = min(bbx_w, tw - glyph_left_x)
         
-        # 将 BDF 位图复制到画布
-        for row_idx, row_val in enumerate(bitmap):
+        for row_idx in range(row_lo, row_hi):
+            row = start + row_idx * byte_width
             canvas_y = glyph_top_y + row_idx
-            if canvas_y < 0 or canvas_y >= target_height:
-                continue
-            
-            # BDF 位图是从高位开始的
-            # 需要根据 BBX 宽度正确解析
-            for bit_idx in range(bbx_w):
-                canvas_x = glyph_left_x + bit_idx
-                if canvas_x < 0 or canvas_x >= target_width:
-                    continue
-                
-                # 计算位图中对应的位
-                # BDF 的位图是按字节存储的，MSB 在左边
-                byte_width = (bbx_w + 7) // 8 * 8  # 对齐到字节边界
-                bit_pos = byte_width - 1 - bit_idx
-                
-                if (row_val >> bit_pos) & 1:
-                    canvas[canvas_y][canvas_x] = 1
-    
-    # 将画布转换为打包的字节
-    bits = []
-    for row in canvas:
-        bits.extend(row)
-    
-    # 打包成字节 (MSB first)
-    byte_count = (len(bits) + 7) // 8
-    result = bytearray(byte_count)
-    for i, bit in enumerate(bits):
-        if bit:
-            result[i // 8] |= (0x80 >> (i % 8))
-    
-    return bytes(result)
-
-
-def create_fnt_file(bdf_path: str, fnt_path: str, target_width: int = None, target_height: int = None):
+            for bit_idx in range(bit_lo, bit_hi):
+                canvas[g, canvas_y, glyph_left_x + bit_idx] = \
+                    (bitmap_flat[row + (bit_idx >> 3)] >> (7 - (bit_idx & 7))) & 1
+
+if HAS_NUMBA:
+    _render_all = njit(parallel=True, cache=True)(_render_all)
+
+
+def render_all_glyphs(glyphs: list[dict], target_width: int, target_height: int,
+                      font_ascent: int, font_descent: int) -> list[bytes]:
+    """
+    渲染全部字形，返回与 glyphs 顺序一致的位图列表
+    
+    安装了 NumPy + Numba 时打包成扁平数组后一次性调用 _render_all，
+    否则用 make_glyph_renderer 特化出的渲染函数逐个渲染。
+    """
+    if not HAS_NUMBA:
+        render = make_glyph_renderer(target_width, target_height, font_ascent)
+        return [render(g) for g in glyphs]
+    
+    n = len(glyphs)
+    bbx = np.empty((n, 4), dtype=np.int32)
+    bitmap_off = np.zeros(n + 1, dtype=np.int64)
+    chunks = []
+    for i, g in enumerate(glyphs):
+        bbx[i] = (g['bbx_w'], g['bbx_h'], g['bbx_x'], g['bbx_y'])
+        data = g['bitmap_bytes']
+        chunks.append(data)
+        bitmap_off[i + 1] = bitmap_off[i] + len(data)
+    bitmap_flat = np.frombuffer(b''.join(chunks), dtype=np.uint8)
+    
+    canvas = np.zeros((n, target_height, target_width), dtype=np.uint8)
+    if n:
+        _render_all(bitmap_flat, bitmap_off, bbx, font_ascent, target_width, target_height, canvas)
+    
+    # 逐字形 MSB first 打包，每个字形末尾补零到字节边界
+    out = np.packbits(canvas.reshape(n, target_height * target_width), axis=1, bitorder='big')
+    return [row.tobytes() for row in out]
+
+
+def create_fnt_file(bdf_path: str, fnt_path: str, target_width: int = None, target_height: int = None,
+                    parsed: tuple[dict, list[dict]] = None, use_cache: bool = True):
     """
     将 BDF 转换为 FNT 格式
+    
+    parsed: 已解析的 (properties, glyphs)，提供时不再读取 BDF 文件
     """
     print(f"解析 BDF 文件: {bdf_path}")
-    properties, glyphs = parse_bdf(bdf_path)
+    properties, glyphs = parsed or load_bdf(bdf_path, use_cache)
     
     print(f"  字体边界框: {properties.get('fbb_width')}x{properties.get('fbb_height')}")
     print(f"  Ascent: {properties.get('ascent')}, Descent: {properties.get('descent')}")
@@ -218,10 +368,8 @@ def create_fnt_file(bdf_path: str, fnt_path: str, target_width: int = None, targ
     
     # 渲染所有字形
     print("渲染字形...")
-    rendered = []
-    for g in valid_glyphs:
-        bitmap = render_glyph_to_fixed_size(g, target_width, target_height, font_ascent, font_descent)
-        rendered.append((g['encoding'], bitmap))
+    bitmaps = render_all_glyphs(valid_glyphs, target_width, target_height, font_ascent, font_descent)
+    rendered = [(g['encoding'], bitmap) for g, bitmap in zip(valid_glyphs, bitmaps)]
     
     # 构建 FNT 文件
     bytes_per_glyph = (target_width * target_height + 7) // 8
@@ -242,13 +390,14 @@ def create_fnt_file(bdf_path: str, fnt_path: str, target_width: int = None, targ
     index_size = glyph_count * 6
     bitmap_start = 16 + index_size
     
-    index_data = bytearray()
-    bitmap_data = bytearray()
+    # 尺寸已知，一次性分配后原地写入
+    index_data = bytearray(index_size)
+    bitmap_data = bytearray(glyph_count * bytes_per_glyph)
     
     for i, (codepoint, bitmap) in enumerate(rendered):
-        offset = bitmap_start + i * bytes_per_glyph
-        index_data += struct.pack('<HI', codepoint, offset)
-        bitmap_data += bitmap
+        pos = i * bytes_per_glyph
+        struct.pack_into('<HI', index_data, i * 6, codepoint, bitmap_start + pos)
+        bitmap_data[pos:pos + bytes_per_glyph] = bitmap
     
     # 写入文件
     with open(fnt_path, 'wb') as f:
@@ -264,11 +413,14 @@ def create_fnt_file(bdf_path: str, fnt_path: str, target_width: int = None, targ
     print(f"  每字形字节: {bytes_per_glyph}")
 
 
-def verify_glyph(bdf_path: str, codepoint: int, target_width: int = 9, target_height: int = 9):
+def verify_glyph(bdf_path: str, codepoint: int, target_width: int = 9, target_height: int = 9,
+                 parsed: tuple[dict, list[dict]] = None, use_cache: bool = True):
     """
     验证单个字符的渲染结果
+    
+    parsed: 已解析的 (properties, glyphs)，提供时不再读取 BDF 文件
     """
-    properties, glyphs = parse_bdf(bdf_path)
+    properties, glyphs = parsed or load_bdf(bdf_path, use_cache)
     
     font_ascent = properties.get('ascent', 9)
     font_descent = properties.get('descent', 0)
@@ -281,7 +433,7 @@ def verify_glyph(bdf_path: str, codepoint: int, target_width: int = 9, target_he
             print(f"字符 U+{codepoint:04X}:")
             print(f"  BBX: {g['bbx_w']}x{g['bbx_h']} at ({g['bbx_x']}, {g['bbx_y']})")
             print(f"  DWidth: {g['dwidth']}")
-            print(f"  原始位图行数: {len(g['bitmap'])}")
+            print(f"  原始位图行数: {len(g['bitmap_bytes']) // g['bytes_per_row'] if g['bytes_per_row'] else 0}")
             
             bitmap = render_glyph_to_fixed_size(g, target_width, target_height, font_ascent, font_descent)
             
@@ -309,16 +461,19 @@ def main():
     parser.add_argument('--width', '-W', type=int, help='Target glyph width')
     parser.add_argument('--height', '-H', type=int, help='Target glyph height')
     parser.add_argument('--verify', '-v', type=str, help='Verify a character (hex codepoint, e.g. 4E2D for 中)')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the .bdfcache parse cache')
     
     args = parser.parse_args()
     
     if args.verify:
         codepoint = int(args.verify, 16)
-        verify_glyph(args.input, codepoint, args.width or 9, args.height or 9)
+        verify_glyph(args.input, codepoint, args.width or 9, args.height or 9,
+                     use_cache=not args.no_cache)
     else:
         if not args.output:
             args.output = Path(args.input).with_suffix('.fnt')
-        create_fnt_file(args.input, args.output, args.width, args.height)
+        create_fnt_file(args.input, args.output, args.width, args.height,
+                        use_cache=not args.no_cache)
 
 
 if __name__ == '__main__':
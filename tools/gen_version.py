@@ -15,11 +15,62 @@ from datetime import datetime
 from pathlib import Path
 
 
+GIT_HASH_LEN = 8
+
+
+def _read_git_head(repo_path: Path) -> str:
+    """直接读取 .git/HEAD 解析当前 commit hash（不启动 git 进程），失败返回空字符串"""
+    git_dir = repo_path / '.git'
+    if git_dir.is_file():
+        # worktree / submodule: .git 是内容为 "gitdir: <path>" 的文件
+        content = git_dir.read_text().strip()
+        if not content.startswith('gitdir: '):
+            return ''
+        git_dir = repo_path / content[len('gitdir: '):]
+    
+    # worktree 的分支引用存放在主仓库目录中
+    common_dir = git_dir
+    commondir_file = git_dir / 'commondir'
+    if commondir_file.is_file():
+        common_dir = git_dir / commondir_file.read_text().strip()
+    
+    head = (git_dir / 'HEAD').read_text().strip()
+    if not head.startswith('ref: '):
+        sha = head  # detached HEAD
+    else:
+        ref = head[len('ref: '):]
+        sha = ''
+        for base in (git_dir, common_dir):
+            ref_file = base / ref
+            if ref_file.is_file():
+                sha = ref_file.read_text().strip()
+                break
+        else:
+            packed_refs = common_dir / 'packed-refs'
+            if packed_refs.is_file():
+                for line in packed_refs.read_text().splitlines():
+                    if line.endswith(' ' + ref) and not line.startswith(('#', '^')):
+                        sha = line.split(' ', 1)[0]
+                        break
+    
+    if len(sha) < GIT_HASH_LEN or any(c not in '0123456789abcdef' for c in sha):
+        return ''
+    return sha[:GIT_HASH_LEN]
+
+
 def get_git_hash(repo_path: Path) -> str:
     """获取 git commit 短 hash"""
+    # 优先直接读取 .git 目录，省去 fork/exec git 的开销
+    try:
+        git_hash = _read_git_head(repo_path)
+        if git_hash:
+            return git_hash
+    except OSError:
+        pass
+    
     try:
         result = subprocess.run(
-            ['git', 'rev-parse', '--short', 'HEAD'],
+            ['git', 'rev-parse', f'--short={GIT_HASH_LEN}', 'HEAD'],
             cwd=repo_path,
             capture_output=True,
             text=True,
@@ -15,84 +15,65 @@ TianshanOS Web 资源优化脚本
 import os
 import re
 import sys
-import glob
+import shutil
 import gzip as gzip_module
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+# gzip 压缩时的读写块大小
+GZIP_CHUNK_SIZE = 1 << 20
+
+# 预编译的正则表达式
+# JS 词法单元：字符串字面量 / 单行注释 / 多行注释 / 斜杠 / 其余代码
+_JS_TOKEN = re.compile(r'''
+    (?P<string>"(?:\\[\s\S]|[^"\\])*"?
+             |'(?:\\[\s\S]|[^'\\])*'?
+             |`(?:\\[\s\S]|[^`\\])*`?)
+  | (?P<line_comment>//[^\n]*)
+  | (?P<block_comment>/\*[\s\S]*?(?:\*/|\Z))
+  | (?P<slash>/)
+  | (?P<code>[^"'`/]+)
+''', re.VERBOSE)
+# 正则表达式字面量（简化处理：不识别字符类）及其 flags
+_JS_REGEX_LITERAL = re.compile(r'/(?:\\[\s\S]|[^/\\])*(?:/[^\W\d_]*)?')
+# 出现在这些字符之后的 / 视为正则表达式字面量的开头
+_JS_REGEX_PRECEDERS = frozenset('=(,!&|?:;{}[\n')
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+_CSS_WS = re.compile(r'\s+')
+_CSS_PUNCT = re.compile(r'\s*([{}:;,>~+])\s*')
+_CSS_AND_PAREN = re.compile(r'\band\(')
+_CSS_NOT_PAREN = re.compile(r'\bnot\(')
 
 
 def minify_js(source: str) -> str:
     """简易 JS 压缩：移除注释和多余空白，保留字符串内容"""
     result = []
-    i = 0
+    last = ''  # 已输出内容的最后一个字符
+    pos = 0
     n = len(source)
     
-    while i < n:
-        # 字符串字面量（单引号/双引号/模板字符串）
-        if source[i] in ('"', "'", '`'):
-            quote = source[i]
-            result.append(source[i])
-            i += 1
-            while i < n:
-                if source[i] == '\\' and i + 1 < n:
-                    result.append(source[i])
-                    result.append(source[i + 1])
-                    i += 2
-                elif source[i] == quote:
-                    result.append(source[i])
-                    i += 1
-                    break
-                else:
-                    result.append(source[i])
-                    i += 1
-        # 单行注释
-        elif source[i] == '/' and i + 1 < n and source[i + 1] == '/':
-            # 跳到行尾
-            while i < n and source[i] != '\n':
-                i += 1
-        # 多行注释
-        elif source[i] == '/' and i + 1 < n and source[i + 1] == '*':
-            i += 2
-            while i < n - 1:
-                if source[i] == '*' and source[i + 1] == '/':
-                    i += 2
-                    break
-                i += 1
-            else:
-                i = n
-        # 正则表达式字面量（简化处理）
-        elif source[i] == '/' and i > 0 and result and result[-1] in ('=', '(', ',', '!', '&', '|', '?', ':', ';', '{', '}', '[', '\n'):
-            result.append(source[i])
-            i += 1
-            while i < n:
-                if source[i] == '\\' and i + 1 < n:
-                    result.append(source[i])
-                    result.append(source[i + 1])
-                    i += 2
-                elif source[i] == '/':
-                    result.append(source[i])
-                    i += 1
-                    # Regex flags
-                    while i < n and source[i].isalpha():
-                        result.append(source[i])
-                        i += 1
-                    break
-                else:
-                    result.append(source[i])
-                    i += 1
-        else:
-            result.append(source[i])
-            i += 1
+    while pos < n:
+        m = _JS_TOKEN.match(source, pos)
+        kind = m.lastgroup
+        
+        if kind in ('line_comment', 'block_comment'):
+            # 注释直接丢弃（单行注释保留行尾换行）
+            pos = m.end()
+            continue
+        
+        if kind == 'slash' and last in _JS_REGEX_PRECEDERS:
+            m = _JS_REGEX_LITERAL.match(source, pos)
+        
+        token = m.group()
+        result.append(token)
+        last = token[-1]
+        pos = m.end()
     
     text = ''.join(result)
     
-    # 合并多余空行为单个换行
-    text = re.sub(r'\n\s*\n+', '\n', text)
-    # 移除行首空白（保留至少一个空格在关键字之间）
-    lines = []
-    for line in text.split('\n'):
-        stripped = line.strip()
-        if stripped:
-            lines.append(stripped)
-    text = '\n'.join(lines)
+    # 去除每行首尾空白并丢弃空行（空行合并随之完成）
+    # 不用 splitlines()：它还会在字符串字面量内的 \r、\u2028 等字符处断行
+    text = '\n'.join(line for line in map(str.strip, text.split('\n')) if line)
     
     return text
 
@@ -100,19 +81,60 @@ def minify_js(source: str) -> str:
 def minify_css(source: str) -> str:
     """CSS 压缩：移除注释和多余空白"""
     # 移除注释
-    result = re.sub(r'/\*.*?\*/', '', source, flags=re.DOTALL)
+    result = _CSS_COMMENT.sub('', source)
     # 移除多余空白
-    result = re.sub(r'\s+', ' ', result)
+    result = _CSS_WS.sub(' ', result)
     # 移除 { } ; : , 前后多余空格
-    result = re.sub(r'\s*([{}:;,>~+])\s*', r'\1', result)
+    result = _CSS_PUNCT.sub(r'\1', result)
     # 恢复某些必要的空格（如 "and (" in media queries）
-    result = re.sub(r'\band\(', 'and (', result)
-    result = re.sub(r'\bnot\(', 'not (', result)
+    result = _CSS_AND_PAREN.sub('and (', result)
+    result = _CSS_NOT_PAREN.sub('not (', result)
     # 移除末尾分号（在 } 前）
     result = result.replace(';}', '}')
     return result.strip()
 
 
+def _minify_file(filepath: str, minifier) -> tuple[int, int]:
+    """就地压缩单个文件，返回 (原始大小, 压缩后大小)"""
+    original_size = os.path.getsize(filepath)
+    with open(filepath, 'r', encoding='utf-8') as f:
+        content = f.read()
+    
+    minified = minifier(content)
+    
+    with open(filepath, 'w', encoding='utf-8') as f:
+        f.write(minified)
+    
+    return original_size, os.path.getsize(filepath)
+
+
+def _gzip_file(filepath: str) -> tuple[int, int]:
+    """生成单个文件的 .gz 副本，返回 (原始大小, 压缩后大小)"""
+    original_size = os.path.getsize(filepath)
+    gz_path = filepath + '.gz'
+    
+    with open(filepath, 'rb') as f_in:
+        with gzip_module.open(gz_path, 'wb', compresslevel=9) as f_out:
+            # 分块流式压缩，避免整个文件读入内存
+            shutil.copyfileobj(f_in, f_out, length=GZIP_CHUNK_SIZE)
+    
+    return original_size, os.path.getsize(gz_path)
+
+
+def _collect_files(web_dir: str, extensions: tuple[str, ...]) -> dict[str, list[str]]:
+    """单次遍历目录，按扩展名归类文件（与 glob 一致，跳过隐藏文件和目录）"""
+    files_by_ext = {ext: [] for ext in extensions}
+    for root, dirnames, filenames in os.walk(web_dir, followlinks=True):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for filename in sorted(filenames):
+            if filename.startswith('.'):
+                continue
+            ext = os.path.splitext(filename)[1]
+            if ext in files_by_ext:
+                files_by_ext[ext].append(os.path.join(root, filename))
+    return files_by_ext
+
+
 def process_directory(web_dir: str) -> None:
     """处理 web 目录下所有 JS/CSS 文件"""
     if not os.path.isdir(web_dir):
@@ -121,41 +143,24 @@ def process_directory(web_dir: str) -> None:
     
     total_saved = 0
     
-    # 处理 JS 文件
-    for filepath in glob.glob(os.path.join(web_dir, '**', '*.js'), recursive=True):
-        original_size = os.path.getsize(filepath)
-        with open(filepath, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        minified = minify_js(content)
-        
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(minified)
-        
-        new_size = os.path.getsize(filepath)
-        saved = original_size - new_size
-        total_saved += saved
-        pct = (saved / original_size * 100) if original_size > 0 else 0
-        rel_path = os.path.relpath(filepath, web_dir)
-        print(f"  JS  {rel_path}: {original_size:,} -> {new_size:,} ({pct:.1f}% saved)")
-    
-    # 处理 CSS 文件
-    for filepath in glob.glob(os.path.join(web_dir, '**', '*.css'), recursive=True):
-        original_size = os.path.getsize(filepath)
-        with open(filepath, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        minified = minify_css(content)
-        
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(minified)
-        
-        new_size = os.path.getsize(filepath)
-        saved = original_size - new_size
-        total_saved += saved
-        pct = (saved / original_size * 100) if original_size > 0 else 0
-        rel_path = os.path.relpath(filepath, web_dir)
-        print(f"  CSS {rel_path}: {original_size:,} -> {new_size:,} ({pct:.1f}% saved)")
+    files_by_ext = _collect_files(web_dir, ('.js', '.css'))
+    jobs = []
+    for filepath in files_by_ext['.js']:
+        jobs.append(('JS ', filepath, minify_js))
+    for filepath in files_by_ext['.css']:
+        jobs.append(('CSS', filepath, minify_css))
+    
+    # 压缩器是纯 Python 代码，用多进程绕开 GIL；结果按提交顺序输出
+    with ProcessPoolExecutor() as pool:
+        results = pool.map(_minify_file,
+                           [filepath for _, filepath, _ in jobs],
+                           [minifier for _, _, minifier in jobs])
+        for (label, filepath, _), (original_size, new_size) in zip(jobs, results):
+            saved = original_size - new_size
+            total_saved += saved
+            pct = (saved / original_size * 100) if original_size > 0 else 0
+            rel_path = os.path.relpath(filepath, web_dir)
+            print(f"  {label} {rel_path}: {original_size:,} -> {new_size:,} ({pct:.1f}% saved)")
     
     print(f"\n  Total saved: {total_saved:,} bytes ({total_saved / 1024:.1f} KB)")
 
@@ -166,21 +171,17 @@ def gzip_directory(web_dir: str) -> None:
         print(f"Error: {web_dir} is not a directory")
         sys.exit(1)
     
-    extensions = ('*.js', '*.css', '*.html')
+    extensions = ('.js', '.css', '.html')
     total_original = 0
     total_compressed = 0
     count = 0
     
-    for ext in extensions:
-        for filepath in glob.glob(os.path.join(web_dir, '**', ext), recursive=True):
-            original_size = os.path.getsize(filepath)
-            gz_path = filepath + '.gz'
-            
-            with open(filepath, 'rb') as f_in:
-                with gzip_module.open(gz_path, 'wb', compresslevel=9) as f_out:
-                    f_out.write(f_in.read())
-            
-            gz_size = os.path.getsize(gz_path)
+    files_by_ext = _collect_files(web_dir, extensions)
+    files = [filepath for ext in extensions for filepath in files_by_ext[ext]]
+    
+    # zlib 压缩时会释放 GIL，线程池即可并行
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        for filepath, (original_size, gz_size) in zip(files, pool.map(_gzip_file, files)):
             total_original += original_size
             total_compressed += gz_size
             count += 1
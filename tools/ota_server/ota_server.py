@@ -35,7 +35,9 @@ import hashlib
 import argparse
 import logging
 import struct
+import mmap
 import mimetypes
+import threading
 from pathlib import Path
 from datetime import datetime
 from functools import wraps
@@ -45,22 +47,49 @@ from typing import Optional, Dict, Any, Tuple
 try:
     from flask import Flask, jsonify, request, send_file, Response, abort
     from flask_cors import CORS
+    from werkzeug.http import parse_range_header
 except ImportError:
     print("错误: 需要安装 Flask 和 flask-cors")
     print("运行: pip install flask flask-cors")
     sys.exit(1)
 
+# 可选：orjson 序列化速度更快，未安装时使用标准库 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 可选：watchdog 监听文件变化，未安装时每次请求轮询文件 mtime
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+# 可选：waitress 生产级 WSGI 服务器，未安装时使用 Flask 开发服务器
+try:
+    from waitress import serve as waitress_serve
+except ImportError:
+    waitress_serve = None
+
 # ============================================================================
 #                           配置常量
 # ============================================================================
 
 DEFAULT_PORT = 57807
 DEFAULT_HOST = "0.0.0.0"
+DEFAULT_THREADS = 8  # waitress 工作线程数
 
 # ESP-IDF 应用头结构 (参考 esp_app_format.h)
 ESP_APP_DESC_MAGIC = 0xABCD5432
 ESP_APP_DESC_OFFSET = 0x20  # 在 bin 文件中的偏移
 
+# 不小于该大小的文件通过 mmap 计算 SHA256，避免整文件读入内存
+MMAP_THRESHOLD = 1 << 20
+# 小文件分块计算 SHA256 时复用的缓冲区大小
+HASH_CHUNK_SIZE = 1 << 20
+
 # ============================================================================
 #                           日志配置
 # ============================================================================
@@ -114,6 +143,36 @@ class FirmwareInfo:
         self.valid: bool = False
         self.error: str = ""
 
+def _sha256_file(path: str) -> str:
+    """
+    计算文件的 SHA256
+    
+    大文件通过 mmap 直接由页缓存提供数据；小文件在 Python 3.11+ 上用
+    hashlib.file_digest（读取循环在 C 层完成），否则用固定缓冲区 readinto 分块读取，
+    峰值内存与文件大小无关。
+    """
+    with open(path, 'rb', buffering=0) as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            sha256 = hashlib.sha256()
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                sha256.update(mm)
+            finally:
+                mm.close()
+        elif hasattr(hashlib, 'file_digest'):
+            sha256 = hashlib.file_digest(f, 'sha256')
+        else:
+            sha256 = hashlib.sha256()
+            buf = bytearray(HASH_CHUNK_SIZE)
+            view = memoryview(buf)
+            while n := f.readinto(buf):
+                sha256.update(view[:n])
+    return sha256.hexdigest()
+
+# 固件解析缓存: 路径 -> ((st_mtime_ns, st_size), FirmwareInfo)
+# 固件重新构建后 mtime/size 变化，缓存自然失效
+_fw_cache: Dict[str, Tuple[Tuple[int, int], FirmwareInfo]] = {}
+
 def parse_firmware(filepath: str) -> FirmwareInfo:
     """
     解析固件文件，提取版本信息
@@ -133,27 +192,38 @@ def parse_firmware(filepath: str) -> FirmwareInfo:
     - 0x70: idf_ver (32 bytes, IDF version)
     - 0x90: app_elf_sha256 (32 bytes)
     - 0xB0: reserv2 (20 bytes)
+    
+    解析结果按 (路径, mtime, 大小) 缓存，同一版本固件只计算一次 SHA256。
     """
     info = FirmwareInfo()
     info.file_path = filepath
     
-    if not os.path.exists(filepath):
+    try:
+        st = os.stat(filepath)
+    except OSError:
         info.error = f"文件不存在: {filepath}"
         return info
     
+    cache_key = (st.st_mtime_ns, st.st_size)
+    cached = _fw_cache.get(filepath)
+    if cached and cached[0] == cache_key:
+        return cached[1]
+    
     try:
-        info.size = os.path.getsize(filepath)
+        info.size = st.st_size
         
         with open(filepath, 'rb') as f:
-            # 计算整个文件的 SHA256
-            sha256 = hashlib.sha256()
-            while chunk := f.read(8192):
-                sha256.update(chunk)
-            info.sha256 = sha256.hexdigest()
+            if info.size == 0:
+                info.error = "文件太小，无法读取 app_desc"
+                return info
             
-            # 读取 app_desc
-            f.seek(ESP_APP_DESC_OFFSET)
-            app_desc = f.read(0xC4)  # esp_app_desc_t 大小
+            # 映射整个文件，SHA256 与 app_desc 解析共用一次映射，无需二次读取
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # 计算整个文件的 SHA256
+                info.sha256 = hashlib.sha256(mm).hexdigest()
+                
+                # 读取 app_desc
+                app_desc = mm[ESP_APP_DESC_OFFSET:ESP_APP_DESC_OFFSET + 0xC4]  # esp_app_desc_t 大小
             
             if len(app_desc) < 0xC4:
                 info.error = "文件太小，无法读取 app_desc"
@@ -177,9 +247,58 @@ def parse_firmware(filepath: str) -> FirmwareInfo:
             
     except Exception as e:
         info.error = str(e)
+        return info
     
+    _fw_cache[filepath] = (cache_key, info)
     return info
 
+def dumps_json(obj: Dict[str, Any]) -> bytes:
+    """序列化为 UTF-8 JSON 字节"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+def _with_realpaths(paths) -> set:
+    """返回包含原路径及其 realpath 的集合"""
+    return set(paths) | {os.path.realpath(p) for p in paths}
+
+class _FileChangeHandler(FileSystemEventHandler):
+    """
+    固件/WebUI 文件发生变化时置位 reload 事件；
+    所在目录被删除或移走时置位 watch_lost 事件
+    """
+    
+    def __init__(self, paths, directories, reload_needed: threading.Event,
+                 watch_lost: threading.Event):
+        super().__init__()
+        # 同时保存原路径和 realpath，符号链接路径与事件路径才能对上
+        self.paths = _with_realpaths(paths)
+        self.directories = _with_realpaths(directories)
+        self.reload_needed = reload_needed
+        self.watch_lost = watch_lost
+    
+    # 只读访问（包括本服务器发送文件时的打开/关闭）产生的事件不代表内容变化
+    IGNORED_EVENTS = ('opened', 'closed_no_write')
+    
+    @staticmethod
+    def _matches(path: str, candidates) -> bool:
+        return bool(path) and (path in candidates or os.path.realpath(path) in candidates)
+    
+    def on_any_event(self, event):
+        if event.event_type in self.IGNORED_EVENTS:
+            return
+        # 监听目录被删除或移走（如 idf.py fullclean）后 inotify 监听随之失效，
+        # 之后重建的目录不会再产生事件，需交由 mtime 轮询接管
+        if (event.is_directory and event.event_type in ('deleted', 'moved')
+                and self._matches(event.src_path, self.directories)):
+            self.watch_lost.set()
+            self.reload_needed.set()
+            return
+        # 构建工具常以 "写临时文件 + 重命名" 的方式更新文件，因此同时检查 dest_path
+        if (self._matches(event.src_path, self.paths)
+                or self._matches(getattr(event, 'dest_path', None), self.paths)):
+            self.reload_needed.set()
+
 # ============================================================================
 #                           OTA 服务器
 # ============================================================================
@@ -187,13 +306,15 @@ def parse_firmware(filepath: str) -> FirmwareInfo:
 class OTAServer:
     """OTA 更新服务器"""
     
-    def __init__(self, firmware_path: str, www_path: Optional[str] = None):
+    def __init__(self, firmware_path: str, www_path: Optional[str] = None,
+                 use_x_sendfile: bool = False):
         """
         初始化 OTA 服务器
         
         Args:
             firmware_path: 固件文件路径
             www_path: WebUI 文件路径（可选）
+            use_x_sendfile: 由前端反向代理通过 X-Sendfile 发送文件（可选）
         """
         self.firmware_path = os.path.abspath(firmware_path) if firmware_path else None
         self.www_path = os.path.abspath(www_path) if www_path else None
@@ -205,7 +326,24 @@ class OTAServer:
         self._firmware_mtime: float = 0
         self._www_mtime: float = 0
         
+        # 文件监听（watchdog 可用且调用 run() 时启用），未启用时每次请求轮询 mtime
+        self._observer = None
+        self._reload_needed = threading.Event()
+        self._watch_lost = threading.Event()
+        
+        # SHA256 缓存: 路径 -> (st_size, st_mtime_ns, sha256)
+        # 固件文件由 parse_firmware 的模块级缓存处理
+        self._hash_cache: Dict[str, Tuple[int, int, str]] = {}
+        
+        # 预先序列化的 / 和 /version 响应体，固件信息重新加载时更新
+        self._index_json: bytes = b""
+        self._version_json: Optional[bytes] = None
+        self._version_etag: str = ""
+        
         self.app = Flask(__name__)
+        # 部署在支持 X-Sendfile 的反向代理（Apache mod_xsendfile / lighttpd）之后时，
+        # 文件内容由代理直接从磁盘发送，Python 进程只返回响应头
+        self.app.config['USE_X_SENDFILE'] = use_x_sendfile
         CORS(self.app, resources={
             r"/*": {
                 "origins": "*",
@@ -222,16 +360,16 @@ class OTAServer:
         """检查固件文件是否有变化，如有变化则自动重新加载"""
         changed = False
         
-        # 检查固件文件
-        if self.firmware_path and os.path.exists(self.firmware_path):
-            mtime = os.path.getmtime(self.firmware_path)
-            if mtime != self._firmware_mtime:
-                changed = True
-        
-        # 检查 WebUI 文件
-        if self.www_path and os.path.exists(self.www_path):
-            mtime = os.path.getmtime(self.www_path)
-            if mtime != self._www_mtime:
+        # 检查固件文件和 WebUI 文件（每个文件只调用一次 stat）
+        for path, last_mtime in ((self.firmware_path, self._firmware_mtime),
+                                 (self.www_path, self._www_mtime)):
+            if not path:
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if mtime != last_mtime:
                 changed = True
         
         if changed:
@@ -256,16 +394,62 @@ class OTAServer:
             logger.warning(f"⚠️ 固件文件不存在: {self.firmware_path}")
         
         if self.www_path and os.path.exists(self.www_path):
-            self._www_mtime = os.path.getmtime(self.www_path)
+            st = os.stat(self.www_path)
+            self._www_mtime = st.st_mtime
             self.www_info = FirmwareInfo()
             self.www_info.file_path = self.www_path
-            self.www_info.size = os.path.getsize(self.www_path)
-            with open(self.www_path, 'rb') as f:
-                self.www_info.sha256 = hashlib.sha256(f.read()).hexdigest()
+            self.www_info.size = st.st_size
+            
+            # 文件未变化（大小和 mtime 相同）时复用上次计算的 SHA256
+            cached = self._hash_cache.get(self.www_path)
+            if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+                self.www_info.sha256 = cached[2]
+            else:
+                self.www_info.sha256 = _sha256_file(self.www_path)
+                self._hash_cache[self.www_path] = (st.st_size, st.st_mtime_ns, self.www_info.sha256)
             self.www_info.valid = True
             logger.info(f"🌐 WebUI: {self.www_info.size:,} bytes")
         elif self.www_path:
             logger.warning(f"⚠️ WebUI 文件不存在: {self.www_path}")
+        
+        self._index_json = self._build_index_json()
+        self._version_json = self._build_version_json()
+        # ETag 取响应体的哈希（同时反映固件和 WebUI 的变化）
+        self._version_etag = hashlib.sha256(self._version_json).hexdigest()[:16] if self._version_json else ""
+    
+    def _build_index_json(self) -> bytes:
+        """生成 / 响应体"""
+        return dumps_json({
+            "server": "TianShanOS OTA Server",
+            "version": "1.0.0",
+            "endpoints": {
+                "/version": "获取固件版本信息 (GET)",
+                "/firmware": "下载固件文件 (GET)",
+                "/www": "下载 WebUI 文件 (GET)",
+                "/health": "健康检查 (GET)"
+            },
+            "firmware_available": self.firmware_info.valid if self.firmware_info else False,
+            "www_available": self.www_info.valid if self.www_info else False
+        })
+    
+    def _build_version_json(self) -> Optional[bytes]:
+        """生成 /version 响应体，固件不可用时返回 None"""
+        if not self.firmware_info or not self.firmware_info.valid:
+            return None
+        
+        return dumps_json({
+            "version": self.firmware_info.version,
+            "project_name": self.firmware_info.project_name,
+            "compile_date": self.firmware_info.compile_date,
+            "compile_time": self.firmware_info.compile_time,
+            "idf_version": self.firmware_info.idf_version,
+            "secure_version": self.firmware_info.secure_version,
+            "size": self.firmware_info.size,
+            "sha256": self.firmware_info.sha256,
+            "www_available": self.www_info.valid if self.www_info else False,
+            "www_size": self.www_info.size if self.www_info and self.www_info.valid else 0,
+            "www_sha256": self.www_info.sha256 if self.www_info and self.www_info.valid else ""
+        })
     
     def _setup_routes(self):
         """设置路由"""
@@ -273,35 +457,39 @@ class OTAServer:
         @self.app.before_request
         def check_updates():
             """每次请求前检查固件是否有更新"""
-            self._check_file_changed()
+            observer = self._observer
+            if observer is not None and (self._watch_lost.is_set() or not observer.is_alive()):
+                # 文件监听已失效，停止 watchdog 并恢复每次请求轮询 mtime
+                self._observer = None
+                observer.stop()
+                self._reload_needed.clear()
+                logger.warning("⚠️ 文件监听失效（目录被删除或移动），改为轮询文件变化")
+            
+            if self._observer is None:
+                self._check_file_changed()
+            elif self._reload_needed.is_set():
+                self._reload_needed.clear()
+                logger.info("🔄 检测到固件文件更新，自动重新加载...")
+                self._load_firmware_info()
         
         @self.app.before_request
         def log_request():
-            """记录请求日志"""
-            client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-            logger.info(f"📥 {request.method} {request.path} from {client_ip}")
+            """记录请求日志（日志级别高于 INFO 时跳过）"""
+            if logger.isEnabledFor(logging.INFO):
+                client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
+                logger.info("📥 %s %s from %s", request.method, request.path, client_ip)
         
         @self.app.after_request
         def log_response(response):
-            """记录响应日志"""
-            logger.debug(f"📤 {response.status_code} {response.content_length or 0} bytes")
+            """记录响应日志（仅 DEBUG 级别）"""
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("📤 %s %s bytes", response.status_code, response.content_length or 0)
             return response
         
         @self.app.route('/')
         def index():
             """服务器首页"""
-            return jsonify({
-                "server": "TianShanOS OTA Server",
-                "version": "1.0.0",
-                "endpoints": {
-                    "/version": "获取固件版本信息 (GET)",
-                    "/firmware": "下载固件文件 (GET)",
-                    "/www": "下载 WebUI 文件 (GET)",
-                    "/health": "健康检查 (GET)"
-                },
-                "firmware_available": self.firmware_info.valid if self.firmware_info else False,
-                "www_available": self.www_info.valid if self.www_info else False
-            })
+            return Response(self._index_json, mimetype='application/json')
         
         @self.app.route('/health')
         def health():
@@ -323,25 +511,17 @@ class OTAServer:
         @self.app.route('/version')
         def version():
             """返回固件版本信息"""
-            if not self.firmware_info or not self.firmware_info.valid:
+            version_json = self._version_json
+            if version_json is None:
                 return jsonify({
                     "error": "固件不可用",
                     "message": self.firmware_info.error if self.firmware_info else "未配置固件路径"
                 }), 503
             
-            return jsonify({
-                "version": self.firmware_info.version,
-                "project_name": self.firmware_info.project_name,
-                "compile_date": self.firmware_info.compile_date,
-                "compile_time": self.firmware_info.compile_time,
-                "idf_version": self.firmware_info.idf_version,
-                "secure_version": self.firmware_info.secure_version,
-                "size": self.firmware_info.size,
-                "sha256": self.firmware_info.sha256,
-                "www_available": self.www_info.valid if self.www_info else False,
-                "www_size": self.www_info.size if self.www_info and self.www_info.valid else 0,
-                "www_sha256": self.www_info.sha256 if self.www_info and self.www_info.valid else ""
-            })
+            response = Response(version_json, mimetype='application/json')
+            response.set_etag(self._version_etag)
+            # 客户端携带相同的 If-None-Match 时返回 304
+            return response.make_conditional(request)
         
         @self.app.route('/firmware')
         def firmware():
@@ -399,64 +579,69 @@ class OTAServer:
             }), 404
         
         filepath = file_info.file_path
-        filesize = file_info.size
         
-        # 检查 Range 请求
+        # 非 bytes 单位、格式错误或多段的 Range 按 RFC 9110 §14.2 忽略，返回完整文件；
+        # 只有格式正确但超出文件范围的单段 Range 才返回 416
         range_header = request.headers.get('Range')
-        
         if range_header:
-            # 解析 Range: bytes=start-end
-            try:
-                range_match = range_header.replace('bytes=', '').split('-')
-                start = int(range_match[0]) if range_match[0] else 0
-                end = int(range_match[1]) if range_match[1] else filesize - 1
-                
-                if start >= filesize or end >= filesize or start > end:
-                    return Response(
-                        "Range Not Satisfiable",
-                        status=416,
-                        headers={'Content-Range': f'bytes */{filesize}'}
-                    )
-                
-                length = end - start + 1
-                
-                with open(filepath, 'rb') as f:
-                    f.seek(start)
-                    data = f.read(length)
-                
-                response = Response(
-                    data,
-                    status=206,
-                    mimetype=content_type,
-                    direct_passthrough=True
-                )
-                response.headers['Content-Range'] = f'bytes {start}-{end}/{filesize}'
-                response.headers['Content-Length'] = length
-                response.headers['Accept-Ranges'] = 'bytes'
-                response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
-                
-                logger.info(f"   Range: {start}-{end}/{filesize} ({length} bytes)")
-                return response
-                
-            except (ValueError, IndexError) as e:
-                logger.warning(f"Invalid Range header: {range_header}")
+            rng = parse_range_header(range_header)
+            if rng is None or rng.units != 'bytes' or len(rng.ranges) != 1:
+                request.environ.pop('HTTP_RANGE', None)
         
-        # 完整文件下载
+        # Range / If-Range / If-None-Match 等条件请求由 Werkzeug 处理：
+        # 单段 Range 返回 206 + Content-Range，越界返回 416，
+        # ETag (SHA256) 或修改时间匹配时返回 304，不发送文件内容。
+        # 传入文件路径，由 WSGI 服务器的 wsgi.file_wrapper 发送（gunicorn 等使用 sendfile(2) 零拷贝）
         response = send_file(
             filepath,
             mimetype=content_type,
             as_attachment=True,
-            download_name=download_name
+            download_name=download_name,
+            conditional=True,
+            etag=file_info.sha256,
+            last_modified=os.path.getmtime(filepath)
         )
         response.headers['Accept-Ranges'] = 'bytes'
-        response.headers['Content-Length'] = filesize
         response.headers['X-SHA256'] = file_info.sha256
         
+        if response.status_code == 206:
+            logger.info(f"   Range: {response.headers.get('Content-Range')} ({response.content_length} bytes)")
+        
         return response
     
+    def _start_file_watcher(self) -> bool:
+        """启动 watchdog 文件监听，成功返回 True"""
+        if Observer is None:
+            return False
+        
+        paths = [p for p in (self.firmware_path, self.www_path) if p]
+        # 同时监听符号链接所在目录和目标文件所在目录
+        directories = {os.path.dirname(p) for p in _with_realpaths(paths)}
+        # 再监听上级目录，才能收到监听目录自身被移走的事件
+        parents = {os.path.dirname(d) for d in directories} - directories
+        self._watch_lost.clear()
+        handler = _FileChangeHandler(paths, directories, self._reload_needed, self._watch_lost)
+        observer = Observer()
+        try:
+            for directory in directories | {d for d in parents if os.path.isdir(d)}:
+                observer.schedule(handler, directory, recursive=False)
+            observer.daemon = True
+            observer.start()
+        except Exception as e:
+            logger.warning(f"⚠️ 文件监听启动失败，改为轮询: {e}")
+            return False
+        
+        self._observer = observer
+        return True
+    
     def run(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, 
             debug: bool = False):
-        """启动服务器"""
+        """
+        启动服务器
+        
+        已安装 waitress 时使用 waitress 提供服务（多线程的生产级 WSGI 服务器，
+        替代 Flask 开发服务器）；调试模式或未安装 waitress 时使用 Flask 开发服务器。
+        """
         logger.info("=" * 60)
         logger.info("🚀 TianShanOS OTA 服务器启动")
         logger.info("=" * 60)
@@ -471,7 +656,18 @@ class OTAServer:
         logger.info(f"  GET /health   - 健康检查")
         logger.info("=" * 60)
         
-        self.app.run(host=host, port=port, debug=debug, threaded=True)
+        if self._start_file_watcher():
+            logger.info("👀 已启用文件监听 (watchdog)")
+        
+        try:
+            if waitress_serve is not None and not debug:
+                logger.info(f"⚙️ WSGI 服务器: waitress ({DEFAULT_THREADS} 线程)")
+                waitress_serve(self.app, host=host, port=port, threads=DEFAULT_THREADS, _quiet=True)
+            else:
+                self.app.run(host=host, port=port, debug=debug, threaded=True)
+        finally:
+            if self._observer is not None:
+                self._observer.stop()
 
 # ============================================================================
 #                           命令行接口
@@ -554,6 +750,8 @@ def main():
                         help='启用调试模式')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='详细输出')
+    parser.add_argument('--x-sendfile', action='store_true',
+                        help='通过 X-Sendfile 头交由反向代理发送文件')
     
     args = parser.parse_args()
     
@@ -589,7 +787,7 @@ def main():
         sys.exit(1)
     
     # 创建并启动服务器
-    server = OTAServer(firmware_path, www_path)
+    server = OTAServer(firmware_path, www_path, use_x_sendfile=args.x_sendfile)
     
     try:
         server.run(host=args.host, port=args.port, debug=args.debug)